@@ -1,6 +1,7 @@
 """
 Database operations using SQLite with aiosqlite
 """
+import asyncio
 import aiosqlite
 from datetime import datetime
 from pathlib import Path
@@ -8,214 +9,336 @@ from typing import Optional
 
 DATABASE_PATH = Path("data/rss_aggregator.db")
 
+# WAL lets RSS readers proceed while the updater writes
+CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA busy_timeout=10000;
+    PRAGMA mmap_size=268435456;
+"""
+
+# Shared connection, opened in init_db() and reused by every function
+_db: Optional[aiosqlite.Connection] = None
+# Keeps concurrent writers from interleaving statements in one transaction
+_write_lock = asyncio.Lock()
+
 
 async def init_db():
-    """Initialize database with required tables"""
+    """Open the shared connection and initialize required tables"""
+    global _db
     DATABASE_PATH.parent.mkdir(parents=True, exist_ok=True)
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS feed_sources (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                max_items INTEGER DEFAULT 30,
-                last_updated TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS feed_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                feed_id INTEGER NOT NULL,
-                guid TEXT NOT NULL,
-                title TEXT NOT NULL,
-                link TEXT,
-                description TEXT,
-                pub_date TIMESTAMP,
-                author TEXT,
-                is_hidden INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (feed_id) REFERENCES feed_sources(id) ON DELETE CASCADE,
-                UNIQUE(feed_id, guid)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_feed_items_feed_id ON feed_items(feed_id)
-        """)
-        await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_feed_items_pub_date ON feed_items(pub_date)
-        """)
-        
-        # Migration: add max_items column if not exists
+    _db = await aiosqlite.connect(DATABASE_PATH)
+    await _db.executescript(CONNECTION_PRAGMAS)
+    _db.row_factory = aiosqlite.Row
+    
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS feed_sources (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            max_items INTEGER DEFAULT 30,
+            last_updated TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS feed_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            feed_id INTEGER NOT NULL,
+            guid TEXT NOT NULL,
+            title TEXT NOT NULL,
+            link TEXT,
+            description TEXT,
+            pub_date INTEGER,
+            pub_date_rfc TEXT,
+            author TEXT,
+            is_hidden INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (feed_id) REFERENCES feed_sources(id) ON DELETE CASCADE,
+            UNIQUE(feed_id, guid)
+        )
+    """)
+    
+    await _db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_feed_items_feed_id ON feed_items(feed_id)
+    """)
+    await _db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_feed_items_feed_pubdate ON feed_items(feed_id, pub_date DESC)
+    """)
+    # Ordered scan for the combined feed and the age-based cleanup
+    await _db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_feed_items_pub_date ON feed_items(pub_date)
+    """)
+    
+    # Migration: add max_items column if not exists
+    try:
+        await _db.execute("ALTER TABLE feed_sources ADD COLUMN max_items INTEGER DEFAULT 30")
+    except:
+        pass  # Column already exists
+    
+    # Migration: add is_hidden column if not exists
+    try:
+        await _db.execute("ALTER TABLE feed_items ADD COLUMN is_hidden INTEGER DEFAULT 0")
+    except:
+        pass  # Column already exists
+    
+    # Migration: store pub_date as unix seconds instead of ISO text
+    await _db.execute("""
+        UPDATE feed_items SET pub_date = CAST(strftime('%s', pub_date) AS INTEGER)
+        WHERE typeof(pub_date) = 'text'
+    """)
+    
+    # Migration: add preformatted RFC 2822 pub_date column if not exists
+    try:
+        await _db.execute("ALTER TABLE feed_items ADD COLUMN pub_date_rfc TEXT")
+    except:
+        pass  # Column already exists
+    
+    # Migration: add adaptive polling columns if not exist
+    for column in ("poll_interval_sec INTEGER", "next_poll_at INTEGER"):
         try:
-            await db.execute("ALTER TABLE feed_sources ADD COLUMN max_items INTEGER DEFAULT 30")
+            await _db.execute(f"ALTER TABLE feed_sources ADD COLUMN {column}")
         except:
             pass  # Column already exists
-        
-        # Migration: add is_hidden column if not exists
+    
+    # Migration: add HTTP cache validator columns if not exist
+    for column in ("etag", "last_modified"):
         try:
-            await db.execute("ALTER TABLE feed_items ADD COLUMN is_hidden INTEGER DEFAULT 0")
+            await _db.execute(f"ALTER TABLE feed_sources ADD COLUMN {column} TEXT")
         except:
             pass  # Column already exists
-        
-        await db.commit()
+    
+    await _db.commit()
+
+
+async def close_db():
+    """Refresh query planner statistics and close the shared connection"""
+    global _db
+    if _db is None:
+        return
+    await _db.execute("PRAGMA optimize")
+    await _db.close()
+    _db = None
 
 
 async def add_feed_source(url: str, name: str, max_items: int = 30) -> int:
     """Add a new feed source"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute(
+    async with _write_lock:
+        cursor = await _db.execute(
             "INSERT OR IGNORE INTO feed_sources (url, name, max_items) VALUES (?, ?, ?)",
             (url, name, max_items)
         )
-        await db.commit()
+        await _db.commit()
         
-        if cursor.lastrowid:
+        # lastrowid is connection-wide, only trust it when this insert happened
+        if cursor.rowcount == 1:
             return cursor.lastrowid
         
         # If already exists, get the ID
-        cursor = await db.execute(
+        rows = await _db.execute_fetchall(
             "SELECT id FROM feed_sources WHERE url = ?", (url,)
         )
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+        return rows[0][0] if rows else 0
 
 
 async def update_feed_source(feed_id: int, name: str = None, max_items: int = None):
     """Update feed source settings"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _write_lock:
         if name is not None:
-            await db.execute(
+            await _db.execute(
                 "UPDATE feed_sources SET name = ? WHERE id = ?",
                 (name, feed_id)
             )
         if max_items is not None:
-            await db.execute(
+            await _db.execute(
                 "UPDATE feed_sources SET max_items = ? WHERE id = ?",
                 (max_items, feed_id)
             )
-        await db.commit()
+            await _prune_feed_items(feed_id, max_items)
+        await _db.commit()
 
 
 async def get_all_feed_sources() -> list[dict]:
     """Get all feed sources with item counts"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("""
-            SELECT 
-                fs.id, 
-                fs.url, 
-                fs.name, 
-                COALESCE(fs.max_items, 30) as max_items,
-                fs.last_updated,
-                fs.created_at,
-                COUNT(CASE WHEN fi.is_hidden = 0 THEN fi.id END) as item_count
-            FROM feed_sources fs
-            LEFT JOIN feed_items fi ON fs.id = fi.feed_id
-            GROUP BY fs.id
-            ORDER BY fs.created_at DESC
-        """)
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+    rows = await _db.execute_fetchall("""
+        SELECT 
+            fs.id, 
+            fs.url, 
+            fs.name, 
+            COALESCE(fs.max_items, 30) as max_items,
+            fs.last_updated,
+            fs.created_at,
+            fs.etag,
+            fs.last_modified,
+            fs.poll_interval_sec,
+            fs.next_poll_at,
+            COUNT(CASE WHEN fi.is_hidden = 0 THEN fi.id END) as item_count
+        FROM feed_sources fs
+        LEFT JOIN feed_items fi ON fs.id = fi.feed_id
+        GROUP BY fs.id
+        ORDER BY fs.created_at DESC
+    """)
+    return [dict(row) for row in rows]
 
 
 async def get_feed_source_by_id(feed_id: int) -> Optional[dict]:
     """Get a single feed source by ID"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT *, COALESCE(max_items, 30) as max_items FROM feed_sources WHERE id = ?", 
-            (feed_id,)
+    rows = await _db.execute_fetchall(
+        "SELECT *, COALESCE(max_items, 30) as max_items FROM feed_sources WHERE id = ?", 
+        (feed_id,)
+    )
+    return dict(rows[0]) if rows else None
+
+
+async def update_feed_validators(feed_id: int, etag: Optional[str], last_modified: Optional[str]):
+    """Store HTTP ETag / Last-Modified of the last successful feed fetch"""
+    async with _write_lock:
+        await _db.execute(
+            "UPDATE feed_sources SET etag = ?, last_modified = ? WHERE id = ?",
+            (etag, last_modified, feed_id)
+        )
+        await _db.commit()
+
+
+async def update_feed_schedule(feed_id: int, poll_interval_sec: int, next_poll_at: int):
+    """Store adaptive polling interval and next poll time (unix seconds)"""
+    async with _write_lock:
+        await _db.execute(
+            "UPDATE feed_sources SET poll_interval_sec = ?, next_poll_at = ? WHERE id = ?",
+            (poll_interval_sec, next_poll_at, feed_id)
         )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        await _db.commit()
 
 
 async def delete_feed_source(feed_id: int):
     """Delete a feed source and all its items"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("DELETE FROM feed_items WHERE feed_id = ?", (feed_id,))
-        await db.execute("DELETE FROM feed_sources WHERE id = ?", (feed_id,))
-        await db.commit()
-
-
-async def add_feed_items(feed_id: int, items: list[dict], max_items: int = 30):
-    """Add new items to a feed, maintaining max_items limit"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        for item in items:
-            await db.execute("""
-                INSERT OR REPLACE INTO feed_items 
-                (feed_id, guid, title, link, description, pub_date, author, is_hidden)
-                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
-            """, (
+    async with _write_lock:
+        await _db.execute("DELETE FROM feed_items WHERE feed_id = ?", (feed_id,))
+        await _db.execute("DELETE FROM feed_sources WHERE id = ?", (feed_id,))
+        await _db.commit()
+
+
+async def _prune_feed_items(feed_id: int, max_items: int, keep_guids: list[str] = ()):
+    """Keep only max_items visible items, preferring keep_guids then newest, caller commits"""
+    placeholders = ",".join("?" * len(keep_guids))
+    await _db.execute(f"""
+        DELETE FROM feed_items 
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    ORDER BY guid IN ({placeholders}) DESC, pub_date DESC
+                ) AS rn
+                FROM feed_items 
+                WHERE feed_id = ? AND is_hidden = 0
+            )
+            WHERE rn > ?
+        )
+    """, (*keep_guids, feed_id, max_items))
+
+
+async def add_feed_items(feed_id: int, items: list[dict], max_items: int = 30) -> int:
+    """Add new items to a feed, maintaining max_items limit. Returns number of new items"""
+    async with _write_lock:
+        # Stored items never change, so only unseen GUIDs need writing
+        existing = {
+            row[0] for row in await _db.execute_fetchall(
+                "SELECT guid FROM feed_items WHERE feed_id = ?", (feed_id,)
+            )
+        }
+        rows = [
+            (
                 feed_id,
                 item['guid'],
                 item['title'],
                 item['link'],
                 item['description'],
                 item['pub_date'],
+                item['pub_date_rfc'],
                 item['author']
-            ))
-        
-        # Update last_updated timestamp
-        await db.execute(
-            "UPDATE feed_sources SET last_updated = ? WHERE id = ?",
-            (datetime.now(), feed_id)
-        )
-        
-        # Keep only the latest max_items (excluding hidden)
-        await db.execute("""
-            DELETE FROM feed_items 
-            WHERE feed_id = ? AND is_hidden = 0 AND id NOT IN (
-                SELECT id FROM feed_items 
-                WHERE feed_id = ? AND is_hidden = 0
-                ORDER BY pub_date DESC 
-                LIMIT ?
             )
-        """, (feed_id, feed_id, max_items))
+            for item in items
+            if item['guid'] not in existing
+        ]
         
-        await db.commit()
+        await _db.execute("BEGIN IMMEDIATE")
+        try:
+            if rows:
+                await _db.executemany("""
+                    INSERT OR IGNORE INTO feed_items 
+                    (feed_id, guid, title, link, description, pub_date, pub_date_rfc, author, is_hidden)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """, rows)
+            
+            # Update last_updated timestamp
+            await _db.execute(
+                "UPDATE feed_sources SET last_updated = ? WHERE id = ?",
+                (datetime.now(), feed_id)
+            )
+            
+            # Items currently listed by the feed rank first even with a stale pub_date,
+            # otherwise they would be re-inserted and pruned on every refresh
+            if rows:
+                await _prune_feed_items(feed_id, max_items, [item['guid'] for item in items])
+            
+            await _db.commit()
+        except Exception:
+            await _db.rollback()
+            raise
+    
+    return len(rows)
 
 
 async def get_feed_items(feed_id: int, limit: int = 30) -> list[dict]:
     """Get items from a specific feed (excluding hidden)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("""
-            SELECT * FROM feed_items 
-            WHERE feed_id = ? AND is_hidden = 0
-            ORDER BY pub_date DESC 
-            LIMIT ?
-        """, (feed_id, limit))
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+    rows = await _db.execute_fetchall("""
+        SELECT * FROM feed_items 
+        WHERE feed_id = ? AND is_hidden = 0
+        ORDER BY pub_date DESC 
+        LIMIT ?
+    """, (feed_id, limit))
+    return [dict(row) for row in rows]
+
+
+async def get_combined_feed_items(limit: int = 100) -> list[dict]:
+    """Get latest items across all feeds (excluding hidden) with their source name"""
+    rows = await _db.execute_fetchall("""
+        SELECT fi.*, fs.name AS source_name
+        FROM feed_items fi
+        JOIN feed_sources fs ON fs.id = fi.feed_id
+        WHERE fi.is_hidden = 0
+        ORDER BY fi.pub_date DESC 
+        LIMIT ?
+    """, (limit,))
+    return [dict(row) for row in rows]
 
 
 async def hide_feed_item(item_id: int):
     """Hide a specific feed item"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
+    async with _write_lock:
+        await _db.execute(
             "UPDATE feed_items SET is_hidden = 1 WHERE id = ?",
             (item_id,)
         )
-        await db.commit()
+        await _db.commit()
 
 
 async def delete_feed_item(item_id: int):
     """Permanently delete a specific feed item"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("DELETE FROM feed_items WHERE id = ?", (item_id,))
-        await db.commit()
+    async with _write_lock:
+        await _db.execute("DELETE FROM feed_items WHERE id = ?", (item_id,))
+        await _db.commit()
 
 
-async def cleanup_old_items(cutoff_date: datetime):
-    """Remove items older than cutoff date"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
+async def cleanup_old_items(cutoff_date: datetime) -> int:
+    """Remove items older than cutoff date. Returns number of removed items"""
+    async with _write_lock:
+        cursor = await _db.execute(
             "DELETE FROM feed_items WHERE pub_date < ?",
-            (cutoff_date,)
+            (int(cutoff_date.timestamp()),)
         )
-        await db.commit()
+        await _db.commit()
+        return cursor.rowcount
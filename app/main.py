@@ -3,37 +3,55 @@ RSS Feed Aggregator - Main Application
 Aggregates RSS feeds, keeps configurable items, and serves as local RSS server
 """
 import asyncio
+import calendar
+import gzip
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Optional
 
 import feedparser
 import httpx
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 
 from app.database import (
     init_db,
+    close_db,
     add_feed_source,
     get_all_feed_sources,
     delete_feed_source,
     update_feed_source,
     add_feed_items,
     get_feed_items,
+    get_combined_feed_items,
     cleanup_old_items,
     get_feed_source_by_id,
+    update_feed_validators,
+    update_feed_schedule,
     hide_feed_item,
     delete_feed_item,
 )
-from app.rss_generator import generate_rss_feed
+from app.rss_generator import generate_rss_feed, rfc2822
 
 DEFAULT_MAX_ITEMS = 30
 CLEANUP_DAYS = 7
 UPDATE_INTERVAL_MINUTES = 5
+CLEANUP_INTERVAL_MINUTES = 60
+# Per-feed polling interval adapts between these bounds
+MIN_POLL_INTERVAL_SEC = UPDATE_INTERVAL_MINUTES * 60
+MAX_POLL_INTERVAL_SEC = 3600
+FETCH_CONCURRENCY = 8
+PARSE_WORKERS = 4
+MAX_FEED_BYTES = 4 * 1024 * 1024
 
 
 class FeedSourceCreate(BaseModel):
@@ -48,73 +66,250 @@ class FeedSourceUpdate(BaseModel):
 
 
 scheduler = AsyncIOScheduler()
+# Caps concurrent feed fetches across scheduled polls and manual refreshes
+fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
 
+# Rendered RSS documents keyed by "all" / "feed:{id}": (content, gzipped content, etag)
+_rss_cache: dict[str, tuple[bytes, bytes, str]] = {}
 
-async def fetch_and_update_feed(feed_id: int, feed_url: str, max_items: int = 30):
-    """Fetch RSS feed and update database"""
+
+def invalidate_rss_cache():
+    """Drop all cached RSS documents so the next request re-renders them"""
+    _rss_cache.clear()
+
+
+def cache_rss(key: str, content: bytes) -> tuple[bytes, bytes, str]:
+    """Store rendered RSS content, its gzipped variant and their ETag"""
+    # Weak ETag since it's shared by the plain and gzip representations
+    etag = f'W/"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+    _rss_cache[key] = (content, gzip.compress(content, compresslevel=6), etag)
+    return _rss_cache[key]
+
+
+def rss_response(request: Request, content: bytes, gzipped: bytes, etag: str) -> Response:
+    """Build RSS response, answering 304 when the client already has this version"""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"max-age={UPDATE_INTERVAL_MINUTES * 60}",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        content = gzipped
+    
+    return Response(
+        content=content,
+        media_type="application/rss+xml; charset=utf-8",
+        headers=headers
+    )
+
+
+async def read_feed_body(response: httpx.Response) -> tuple[bytes, bool]:
+    """Read a streamed feed body up to MAX_FEED_BYTES. Returns (content, truncated)"""
+    content = bytearray()
+    # Cap the body so a misbehaving feed can't exhaust memory
+    async for chunk in response.aiter_bytes():
+        content += chunk
+        if len(content) > MAX_FEED_BYTES:
+            print(f"Feed {response.url} exceeds {MAX_FEED_BYTES} bytes, truncated")
+            return bytes(content), True
+    return bytes(content), False
+
+
+async def parse_feed(response: httpx.Response, content: bytes):
+    """Parse feed bytes in a worker thread"""
+    # feedparser detects the encoding from raw bytes and the Content-Type header
+    return await asyncio.to_thread(
+        feedparser.parse,
+        content,
+        response_headers={"content-type": response.headers.get("content-type", "")}
+    )
+
+
+async def fetch_and_update_feed(
+    client: httpx.AsyncClient,
+    feed_id: int,
+    feed_url: str,
+    max_items: int = 30,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None
+) -> int:
+    """Fetch RSS feed and update database, skipping unchanged feeds.
+    Returns number of new items (0 when unchanged or on error)"""
+    new_count = 0
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(feed_url)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        
+        async with client.stream("GET", feed_url, headers=headers) as response:
+            if response.status_code == 304:
+                print(f"Feed {feed_url} not modified")
+                return 0
             response.raise_for_status()
-            content = response.text
+            content, truncated = await read_feed_body(response)
 
-        feed = feedparser.parse(content)
+        feed = await parse_feed(response, content)
         
         if feed.bozo and not feed.entries:
             print(f"Error parsing feed {feed_url}: {feed.bozo_exception}")
-            return
+            return 0
 
         items = []
         for entry in feed.entries[:max_items]:
-            pub_date = None
-            if hasattr(entry, 'published_parsed') and entry.published_parsed:
-                pub_date = datetime(*entry.published_parsed[:6])
-            elif hasattr(entry, 'updated_parsed') and entry.updated_parsed:
-                pub_date = datetime(*entry.updated_parsed[:6])
+            # Parsed dates are UTC struct_time, store them as unix seconds
+            parsed_date = entry.get('published_parsed') or entry.get('updated_parsed')
+            pub_date = calendar.timegm(parsed_date) if parsed_date else int(time.time())
+            link = entry.get('link') or ''
             
             items.append({
-                'guid': entry.get('id', entry.get('link', '')),
-                'title': entry.get('title', 'Без заголовка'),
-                'link': entry.get('link', ''),
-                'description': entry.get('summary', entry.get('description', '')),
-                'pub_date': pub_date or datetime.now(),
-                'author': entry.get('author', ''),
+                'guid': entry.get('id') or link,
+                'title': entry.get('title') or 'Без заголовка',
+                'link': link,
+                'description': entry.get('summary') or entry.get('description') or '',
+                'pub_date': pub_date,
+                # Formatted once here so RSS rendering can use it verbatim
+                'pub_date_rfc': rfc2822(pub_date),
+                'author': entry.get('author') or '',
             })
 
         if items:
-            await add_feed_items(feed_id, items, max_items)
-            print(f"Updated feed {feed_url}: {len(items)} items")
+            new_count = await add_feed_items(feed_id, items, max_items)
+            print(f"Updated feed {feed_url}: {new_count} new of {len(items)} items")
+        
+        # A truncated body must be fetched in full next time
+        if not truncated:
+            await update_feed_validators(
+                feed_id,
+                response.headers.get("etag"),
+                response.headers.get("last-modified")
+            )
 
     except Exception as e:
         print(f"Error fetching feed {feed_url}: {e}")
+    
+    return new_count
+
+
+def schedule_feed_poll(client: httpx.AsyncClient, feed_id: int, next_poll_at: Optional[int] = None):
+    """Schedule the next poll of a feed, immediately if no time given or already due"""
+    run_date = datetime.fromtimestamp(max(next_poll_at or 0, time.time()))
+    scheduler.add_job(
+        poll_feed,
+        'date',
+        run_date=run_date,
+        args=[client, feed_id],
+        id=f"feed:{feed_id}",
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+
+
+def unschedule_feed_poll(feed_id: int):
+    """Stop polling a removed feed"""
+    try:
+        scheduler.remove_job(f"feed:{feed_id}")
+    except JobLookupError:
+        pass
+
+
+async def poll_feed(client: httpx.AsyncClient, feed_id: int):
+    """Scheduled poll of a single feed, adapting its interval to publish rate"""
+    interval = MIN_POLL_INTERVAL_SEC
+    reschedule = True
+    try:
+        feed = await get_feed_source_by_id(feed_id)
+        if not feed:
+            reschedule = False  # Feed was deleted
+            return
+        
+        interval = feed.get('poll_interval_sec') or MIN_POLL_INTERVAL_SEC
+        max_items = feed.get('max_items', DEFAULT_MAX_ITEMS) or DEFAULT_MAX_ITEMS
+        async with fetch_semaphore:
+            new_count = await fetch_and_update_feed(
+                client,
+                feed_id,
+                feed['url'],
+                max_items,
+                feed.get('etag'),
+                feed.get('last_modified')
+            )
+        
+        # Poll active feeds more often, back off on quiet or failing ones
+        if new_count:
+            interval = max(MIN_POLL_INTERVAL_SEC, interval // 2)
+            invalidate_rss_cache()
+        else:
+            interval = min(MAX_POLL_INTERVAL_SEC, interval * 2)
+        
+        await update_feed_schedule(feed_id, interval, int(time.time()) + interval)
+    finally:
+        # Always reschedule, a failed poll must not stop the feed from updating
+        if reschedule:
+            schedule_feed_poll(client, feed_id, int(time.time()) + interval)
+
+
+async def cleanup_items():
+    """Remove items older than CLEANUP_DAYS"""
+    cutoff_date = datetime.now() - timedelta(days=CLEANUP_DAYS)
+    if await cleanup_old_items(cutoff_date):
+        invalidate_rss_cache()
 
 
-async def update_all_feeds():
-    """Update all registered feeds"""
+async def update_all_feeds(client: httpx.AsyncClient):
+    """Update all registered feeds concurrently"""
     feeds = await get_all_feed_sources()
-    for feed in feeds:
+    
+    async def update_one(feed: dict):
         max_items = feed.get('max_items', DEFAULT_MAX_ITEMS) or DEFAULT_MAX_ITEMS
-        await fetch_and_update_feed(feed['id'], feed['url'], max_items)
+        async with fetch_semaphore:
+            await fetch_and_update_feed(
+                client,
+                feed['id'],
+                feed['url'],
+                max_items,
+                feed.get('etag'),
+                feed.get('last_modified')
+            )
     
-    # Cleanup old items
-    cutoff_date = datetime.now() - timedelta(days=CLEANUP_DAYS)
-    await cleanup_old_items(cutoff_date)
+    await asyncio.gather(*[update_one(feed) for feed in feeds], return_exceptions=True)
+    
+    await cleanup_items()
+    invalidate_rss_cache()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    # Bounded pool for feedparser work offloaded via asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+    )
     await init_db()
+    # One client for all fetches keeps TLS sessions and keepalive connections warm
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        headers={"User-Agent": "rss-aggregator/1.0"}
+    )
     
-    # Initial fetch
-    await update_all_feeds()
+    # Schedule per-feed polling, feeds that are due get fetched right away
+    for feed in await get_all_feed_sources():
+        schedule_feed_poll(app.state.http, feed['id'], feed.get('next_poll_at'))
     
-    # Schedule periodic updates
+    # Schedule periodic cleanup
     scheduler.add_job(
-        update_all_feeds,
+        cleanup_items,
         'interval',
-        minutes=UPDATE_INTERVAL_MINUTES,
-        id='update_feeds'
+        minutes=CLEANUP_INTERVAL_MINUTES,
+        id='cleanup_items'
     )
     scheduler.start()
     
@@ -122,14 +317,20 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     scheduler.shutdown()
+    await app.state.http.aclose()
+    await close_db()
 
 
 app = FastAPI(
     title="RSS Aggregator",
     description="Local RSS feed aggregator with web interface",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
+# RSS endpoints send precompressed bodies, the middleware skips those
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
@@ -160,22 +361,24 @@ async def create_feed(feed: FeedSourceCreate):
     
     # Validate feed URL by trying to parse it
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(feed.url)
+        async with app.state.http.stream("GET", feed.url) as response:
             response.raise_for_status()
-            parsed = feedparser.parse(response.text)
-            
-            if parsed.bozo and not parsed.entries:
-                raise HTTPException(status_code=400, detail="Неправильний RSS формат")
-            
-            feed_name = feed.name or parsed.feed.get('title', 'Без назви')
+            content, _ = await read_feed_body(response)
+        parsed = await parse_feed(response, content)
+        
+        if parsed.bozo and not parsed.entries:
+            raise HTTPException(status_code=400, detail="Неправильний RSS формат")
+        
+        feed_name = feed.name or parsed.feed.get('title', 'Без назви')
     except httpx.HTTPError as e:
         raise HTTPException(status_code=400, detail=f"Помилка завантаження: {str(e)}")
 
     feed_id = await add_feed_source(feed.url, feed_name, max_items)
     
     # Fetch items immediately
-    await fetch_and_update_feed(feed_id, feed.url, max_items)
+    await fetch_and_update_feed(app.state.http, feed_id, feed.url, max_items)
+    invalidate_rss_cache()
+    schedule_feed_poll(app.state.http, feed_id, int(time.time()) + MIN_POLL_INTERVAL_SEC)
     
     return {"id": feed_id, "name": feed_name, "url": feed.url, "max_items": max_items}
 
@@ -191,7 +394,8 @@ async def update_feed(feed_id: int, feed: FeedSourceUpdate):
     
     # If max_items changed, refresh the feed
     if feed.max_items is not None:
-        await fetch_and_update_feed(feed_id, existing['url'], feed.max_items)
+        await fetch_and_update_feed(app.state.http, feed_id, existing['url'], feed.max_items)
+    invalidate_rss_cache()
     
     updated = await get_feed_source_by_id(feed_id)
     return {"status": "updated", "feed": updated}
@@ -201,6 +405,8 @@ async def update_feed(feed_id: int, feed: FeedSourceUpdate):
 async def remove_feed(feed_id: int):
     """Remove a feed source"""
     await delete_feed_source(feed_id)
+    unschedule_feed_poll(feed_id)
+    invalidate_rss_cache()
     return {"status": "deleted"}
 
 
@@ -215,6 +421,7 @@ async def get_items(feed_id: int, limit: int = 30):
 async def remove_item(item_id: int):
     """Hide/delete a specific item"""
     await hide_feed_item(item_id)
+    invalidate_rss_cache()
     return {"status": "hidden"}
 
 
@@ -222,69 +429,60 @@ async def remove_item(item_id: int):
 async def remove_item_permanent(item_id: int):
     """Permanently delete a specific item"""
     await delete_feed_item(item_id)
+    invalidate_rss_cache()
     return {"status": "deleted"}
 
 
 @app.post("/api/feeds/refresh")
 async def refresh_feeds():
     """Manually trigger feed refresh"""
-    await update_all_feeds()
+    await update_all_feeds(app.state.http)
     return {"status": "refreshed"}
 
 
 # ============ RSS Server Endpoints ============
 
 @app.get("/rss/all", response_class=Response)
-async def get_combined_rss():
+async def get_combined_rss(request: Request):
     """Get combined RSS feed of all sources"""
-    feeds = await get_all_feed_sources()
-    all_items = []
-    
-    for feed in feeds:
-        max_items = feed.get('max_items', DEFAULT_MAX_ITEMS) or DEFAULT_MAX_ITEMS
-        items = await get_feed_items(feed['id'], max_items)
-        for item in items:
-            item['source_name'] = feed['name']
-        all_items.extend(items)
-    
-    # Sort by date and limit to combined max
-    all_items.sort(key=lambda x: x['pub_date'] or datetime.min, reverse=True)
-    all_items = all_items[:100]  # Combined feed max 100 items
-    
-    rss_content = generate_rss_feed(
-        title="RSS Aggregator - All Feeds",
-        link="http://localhost:5050/rss/all",
-        description="Combined feed from all sources",
-        items=all_items
-    )
+    cached = _rss_cache.get("all")
+    if cached is None:
+        # Combined feed max 100 items
+        all_items = await get_combined_feed_items(100)
+        
+        rss_content = generate_rss_feed(
+            title="RSS Aggregator - All Feeds",
+            link="http://localhost:5050/rss/all",
+            description="Combined feed from all sources",
+            items=all_items
+        )
+        cached = cache_rss("all", rss_content)
     
-    return Response(
-        content=rss_content.encode('utf-8'),
-        media_type="application/rss+xml; charset=utf-8"
-    )
+    return rss_response(request, *cached)
 
 
 @app.get("/rss/feed/{feed_id}", response_class=Response)
-async def get_single_rss(feed_id: int):
+async def get_single_rss(feed_id: int, request: Request):
     """Get RSS feed for a single source"""
-    feed = await get_feed_source_by_id(feed_id)
-    if not feed:
-        raise HTTPException(status_code=404, detail="Feed not found")
-    
-    max_items = feed.get('max_items', DEFAULT_MAX_ITEMS) or DEFAULT_MAX_ITEMS
-    items = await get_feed_items(feed_id, max_items)
-    
-    rss_content = generate_rss_feed(
-        title=f"RSS Aggregator - {feed['name']}",
-        link=f"http://localhost:5050/rss/feed/{feed_id}",
-        description=f"Cached feed: {feed['name']}",
-        items=items
-    )
+    cache_key = f"feed:{feed_id}"
+    cached = _rss_cache.get(cache_key)
+    if cached is None:
+        feed = await get_feed_source_by_id(feed_id)
+        if not feed:
+            raise HTTPException(status_code=404, detail="Feed not found")
+        
+        max_items = feed.get('max_items', DEFAULT_MAX_ITEMS) or DEFAULT_MAX_ITEMS
+        items = await get_feed_items(feed_id, max_items)
+        
+        rss_content = generate_rss_feed(
+            title=f"RSS Aggregator - {feed['name']}",
+            link=f"http://localhost:5050/rss/feed/{feed_id}",
+            description=f"Cached feed: {feed['name']}",
+            items=items
+        )
+        cached = cache_rss(cache_key, rss_content)
     
-    return Response(
-        content=rss_content.encode('utf-8'),
-        media_type="application/rss+xml; charset=utf-8"
-    )
+    return rss_response(request, *cached)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,87 @@
 """
 RSS Feed Generator - Creates valid RSS 2.0 XML with proper UTF-8 encoding
 """
-from datetime import datetime
-from email.utils import format_datetime
-import html
+import functools
+import re
+import time
+
+from lxml import etree
+from lxml.builder import ElementMaker
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+NSMAP = {"atom": ATOM_NS, "dc": DC_NS}
+
+E = ElementMaker(nsmap=NSMAP)
+ATOM = ElementMaker(namespace=ATOM_NS, nsmap=NSMAP)
+# Items are serialized on their own, keep the root namespace declarations off them
+ITEM = ElementMaker()
+DC = ElementMaker(namespace=DC_NS, nsmap={"dc": DC_NS})
+
+# Characters not allowed anywhere in XML 1.0: C0 controls, lone surrogates, U+FFFE/U+FFFF
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+           "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def rfc2822(timestamp: float) -> str:
+    """Format unix timestamp as RFC 2822 date in UTC"""
+    tm = time.gmtime(timestamp)
+    return (
+        f"{_DAYS[tm.tm_wday]}, {tm.tm_mday:02d} {_MONTHS[tm.tm_mon - 1]} {tm.tm_year} "
+        f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d} +0000"
+    )
+
+
+def xml_text(text: str) -> str:
+    """Drop characters lxml refuses to serialize"""
+    if not text:
+        return ""
+    return INVALID_XML_CHARS.sub("", text)
+
+
+def cdata(text: str):
+    """Wrap text in CDATA section for complex content"""
+    text = xml_text(text)
+    if not text:
+        return ""
+    # CDATA can't contain its own end marker, let lxml escape such text instead
+    if "]]>" in text:
+        return text
+    return etree.CDATA(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def render_item(
+    item_id: int,
+    source_name: str,
+    title: str,
+    link: str,
+    description: str,
+    guid: str,
+    author: str,
+    pub_date_rfc: str
+) -> bytes:
+    """Render a single <item> element, cached since stored items never change"""
+    if source_name:
+        description = f"[{source_name}] {description}"
+
+    item = ITEM.item(
+        ITEM.title(cdata(title)),
+        ITEM.link(xml_text(link)),
+        ITEM.description(cdata(description)),
+        ITEM.guid(xml_text(guid), isPermaLink="false"),
+    )
+
+    if pub_date_rfc:
+        item.append(ITEM.pubDate(pub_date_rfc))
+
+    if author:
+        item.append(DC.creator(cdata(author)))
+
+    return etree.tostring(item, encoding="UTF-8")
 
 
 def generate_rss_feed(
@@ -12,81 +90,43 @@ def generate_rss_feed(
     description: str,
     items: list[dict],
     language: str = "uk"
-) -> str:
-    """Generate RSS 2.0 XML feed with proper UTF-8 encoding"""
-    
-    def escape_xml(text: str) -> str:
-        """Escape XML special characters while preserving UTF-8"""
-        if not text:
-            return ""
-        # Only escape XML special chars, keep UTF-8 as-is
-        return (text
-            .replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-            .replace('"', "&quot;")
-            .replace("'", "&apos;"))
-    
-    def cdata(text: str) -> str:
-        """Wrap text in CDATA section for complex content"""
-        if not text:
-            return ""
-        # If text contains CDATA end marker, escape it
-        text = text.replace("]]>", "]]]]><![CDATA[>")
-        return f"<![CDATA[{text}]]>"
-    
-    last_build = format_datetime(datetime.now())
-    
-    # Build XML manually for proper encoding control
-    xml_parts = [
-        '<?xml version="1.0" encoding="UTF-8"?>',
-        '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/">',
-        '  <channel>',
-        f'    <title>{escape_xml(title)}</title>',
-        f'    <link>{escape_xml(link)}</link>',
-        f'    <description>{escape_xml(description)}</description>',
-        f'    <language>{language}</language>',
-        f'    <lastBuildDate>{last_build}</lastBuildDate>',
-        '    <generator>RSS Aggregator v1.0</generator>',
-        f'    <atom:link href="{escape_xml(link)}" rel="self" type="application/rss+xml"/>',
-    ]
-    
+) -> bytes:
+    """Generate RSS 2.0 XML feed encoded as UTF-8"""
+    channel = E.channel(
+        E.title(xml_text(title)),
+        E.link(xml_text(link)),
+        E.description(xml_text(description)),
+        E.language(language),
+        E.lastBuildDate(rfc2822(time.time())),
+        E.generator("RSS Aggregator v1.0"),
+        ATOM.link(href=xml_text(link), rel="self", type="application/rss+xml"),
+    )
+    document = etree.tostring(
+        E.rss(channel, version="2.0"),
+        xml_declaration=True,
+        encoding="UTF-8"
+    )
+    header, footer = document.rsplit(b"</channel>", 1)
+
+    parts = [header]
     for item_data in items:
-        item_title = item_data.get('title', '')
         item_link = item_data.get('link', '')
-        item_desc = item_data.get('description', '')
-        item_guid = item_data.get('guid', item_link)
-        item_author = item_data.get('author', '')
-        
-        if item_data.get('source_name'):
-            item_desc = f"[{item_data['source_name']}] {item_desc}"
-        
-        pub_date = item_data.get('pub_date')
-        pub_date_str = ""
-        if pub_date:
-            if isinstance(pub_date, str):
-                try:
-                    pub_date = datetime.fromisoformat(pub_date.replace('Z', '+00:00'))
-                except:
-                    pub_date = datetime.now()
-            pub_date_str = format_datetime(pub_date)
-        
-        xml_parts.append('    <item>')
-        xml_parts.append(f'      <title>{cdata(item_title)}</title>')
-        xml_parts.append(f'      <link>{escape_xml(item_link)}</link>')
-        xml_parts.append(f'      <description>{cdata(item_desc)}</description>')
-        xml_parts.append(f'      <guid isPermaLink="false">{escape_xml(item_guid)}</guid>')
-        
-        if pub_date_str:
-            xml_parts.append(f'      <pubDate>{pub_date_str}</pubDate>')
-        
-        if item_author:
-            xml_parts.append(f'      <dc:creator>{cdata(item_author)}</dc:creator>')
-        
-        xml_parts.append('    </item>')
-    
-    xml_parts.append('  </channel>')
-    xml_parts.append('</rss>')
-    
-    return '\n'.join(xml_parts)
 
+        pub_date_str = item_data.get('pub_date_rfc')
+        if not pub_date_str and item_data.get('pub_date'):
+            # Items stored before pub_date_rfc existed
+            pub_date_str = rfc2822(item_data['pub_date'])
+
+        parts.append(render_item(
+            item_data.get('id'),
+            item_data.get('source_name'),
+            item_data.get('title', ''),
+            item_link,
+            item_data.get('description', ''),
+            item_data.get('guid', item_link),
+            item_data.get('author', ''),
+            pub_date_str
+        ))
+
+    parts.append(b"</channel>" + footer)
+    return b"".join(parts)
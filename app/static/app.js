@@ -336,7 +336,8 @@ function stripHtml(html) {
 
 function formatDate(dateStr) {
     try {
-        const date = new Date(dateStr);
+        // Item dates come as unix seconds
+        const date = new Date(typeof dateStr === 'number' ? dateStr * 1000 : dateStr);
         return date.toLocaleDateString('uk-UA', {
             day: 'numeric',
             month: 'long',